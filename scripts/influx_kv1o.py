@@ -12,6 +12,13 @@ from influxdb_client import InfluxDBClient, Point, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS, PointSettings
 
 
+# VaR alphas: 5%, 1%, 0.1%, 0.01%
+ALPHAS = np.array([0.05, 0.01, 0.001, 0.0001])
+
+# Normal quantiles at 1 - alpha for each of `ALPHAS`
+QTILES = norm.ppf(1 - ALPHAS)
+
+
 def get_config() -> tp.Dict:
     return {
         "token": os.getenv('INFLUXDB_TOKEN'),
@@ -70,23 +77,22 @@ def get_points_total(kv1o, q: tp.Dict) -> int:
 # See: https://oips.overlay.market/notes/note-4
 def calc_vars(mu: float,
               sig_sqrd: float,
-              n: int, t: int, alphas: np.ndarray) -> np.ndarray:
+              n: int, t: int, qtile: np.ndarray) -> np.ndarray:
     sig = np.sqrt(sig_sqrd)
-    q = 1-alphas
-    pow = mu*n*t + sig*np.sqrt(n*t)*norm.ppf(q)
+    pow = mu*n*t + sig*np.sqrt(n*t)*qtile
     return np.exp(pow) - 1
 
 
 def get_stats(kv1o, q: tp.Dict, p: tp.Dict) -> (str, pd.DataFrame):
     t = kv1o.periodSize() * q["window"]  # 30m * 2 = 1h
     pair = kv1o.pairFor(q["token_in"], q["token_out"])
-    sample = kv1o.sample(
+    sample = np.array(kv1o.sample(
         q["token_in"],
         q["amount_in"],
         q["token_out"],
         q["points"],
         q["window"]
-    )
+    ), dtype=float)
 
     # TODO: Add in q-q plot to see deviation from GBM given sample
 
@@ -94,14 +100,15 @@ def get_stats(kv1o, q: tp.Dict, p: tp.Dict) -> (str, pd.DataFrame):
     timestamp, _, _ = kv1o.lastObservation(pair)
 
     # mles
-    rs = [np.log(sample[i]/sample[i-1]) for i in range(1, len(sample), 1)]
-    mu = float(np.mean(rs) / t)
-    ss = float(np.var(rs) / t)
+    rs = np.log(sample[1:] / sample[:-1])
+    # reuse the mean for the variance rather than have np.var recompute it
+    m = rs.mean()
+    mu = float(m / t)
+    ss = float(np.square(rs - m).mean() / t)
 
     # VaRs for 5%, 1%, 0.1%, 0.01% alphas, n periods into the future
     n = p["n"]
-    alphas = np.array([0.05, 0.01, 0.001, 0.0001])
-    vars = calc_vars(mu, ss, n, t, alphas)
+    vars = calc_vars(mu, ss, n, t, QTILES)
     data = np.concatenate(([timestamp, mu, ss], vars), axis=None)
 
     df = pd.DataFrame(data=data).T
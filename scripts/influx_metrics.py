@@ -6,16 +6,33 @@ import pandas as pd
 import pystable
 import typing as tp
 
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from functools import lru_cache, partial
 
 from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS, PointSettings
+from influxdb_client.client.write_api import (
+    PointSettings, WriteOptions, WriteType)
 
 
 # Fixed point resolution of price cumulatives
 PC_RESOLUTION = 112
 
 
+@dataclass
+class PriceSeries:
+    '''
+    Time series of a price cumulative field, held as column arrays.
+
+    Attributes:
+        t  [np.ndarray]:  Unix timestamps [s]
+        v  [np.ndarray]:  Price cumulative values at unix timestamps `t`
+    '''
+    t: np.ndarray
+    v: np.ndarray
+
+
 def get_config() -> tp.Dict:
     '''
     Returns a `config` dict containing InfluxDB configuration parameters
@@ -53,6 +70,7 @@ def create_client(config: tp.Dict) -> InfluxDBClient:
     return InfluxDBClient(
             url=config['url'],
             token=config['token'],
+            enable_gzip=True,
             debug=False)
 
 
@@ -100,13 +118,15 @@ def get_quote_path() -> str:
     return os.path.join(base, qp)
 
 
-def get_quotes() -> tp.List:
+@lru_cache(maxsize=1)
+def get_quotes() -> tp.Tuple:
     '''
-    Loads from `scripts/constants/quotes.json` and return a List
-    of quote dicts for quote data fetched from SushiSwap.
+    Loads from `scripts/constants/quotes.json` and return a Tuple
+    of quote dicts for quote data fetched from SushiSwap. The file is only
+    parsed once per process.
 
     Output:
-        [tp.List[dict]]
+        [tp.Tuple[dict]]
         id         [str]:   Name of swap pair
         pair       [str]:   Contract address of swap pair
         token0     [str]:   Contract address of token 0 in swap pair
@@ -119,20 +139,30 @@ def get_quotes() -> tp.List:
                             `priceCumulative1` storage variable
         amount_in  [float]:  Swap input amount
     '''
-    quotes = []
     p = get_quote_path()
     with open(p) as f:
         data = json.load(f)
-        quotes = data.get('quotes', [])
-    return quotes
+    return tuple(data.get('quotes', []))
 
 
 def get_price_fields() -> (str, str):
     return 'price0Cumulative', 'price1Cumulative'
 
 
+def get_price_series(df: pd.DataFrame) -> PriceSeries:
+    '''
+    Returns the `_time` and `_value` columns of the price cumulatives
+    dataframe `df` as a `PriceSeries`, sorted by time.
+    '''
+    t = df['_time'].values.view('int64')
+    order = np.argsort(t, kind='stable')
+    return PriceSeries(
+        t=t[order] / 1e9,
+        v=df['_value'].to_numpy()[order])
+
+
 def get_price_cumulatives(query_api, cfg: tp.Dict, q: tp.Dict, p: tp.Dict
-                          ) -> (int, tp.List[pd.DataFrame]):
+                          ) -> (int, tp.List[PriceSeries]):
     '''
     Fetches `historical time series of priceCumulative` values for the last
     `params['points']` number of days for id `quote['id']` from the config
@@ -169,17 +199,14 @@ def get_price_cumulatives(query_api, cfg: tp.Dict, q: tp.Dict, p: tp.Dict
 
     Outputs:
         [tuple]: Assembled from query
-          timestamp          [int]:               Most recent timestamp of data
-                                                  in `priceCumulative`
-                                                  dataframes
-          priceCumulatives0  [pandas.DataFrame]:
-            _time  [int]:  Unix timestamp
-            _field [str]:  Price field, `price0Cumulative`
-            _value [int]:  `priceCumulative0` at unix timestamp `_time`
-          priceCumulatives1  [pandas.DataFrame]:
-            _time  [int]:  Unix timestamp
-            _field [str]:  Price field, `price1Cumulative`
-            _value [int]:  `priceCumulative1` at unix timestamp `_time`
+          timestamp          [int]:          Most recent timestamp of data
+                                             in `priceCumulative` series
+          priceCumulatives0  [PriceSeries]:
+            t  [np.ndarray]:  Unix timestamps
+            v  [np.ndarray]:  `priceCumulative0` at unix timestamps `t`
+          priceCumulatives1  [PriceSeries]:
+            t  [np.ndarray]:  Unix timestamps
+            v  [np.ndarray]:  `priceCumulative1` at unix timestamps `t`
     '''
     qid = q['id']
     points = p['points']
@@ -187,28 +214,25 @@ def get_price_cumulatives(query_api, cfg: tp.Dict, q: tp.Dict, p: tp.Dict
     org = cfg['org']
 
     print(f'Fetching prices for {qid} ...')
-    query = f'''
-        from(bucket:"{bucket}") |> range(start: -{points}d)
-            |> filter(fn: (r) => r["id"] == "{qid}")
-    '''
-    df = query_api.query_data_frame(query=query, org=org)
-    if type(df) == list:
-        df = pd.concat(df, ignore_index=True)
-
-    # Filter then separate the df into p0c and p1c dataframes
-    df_filtered = df.filter(items=['_time', '_field', '_value'])
-    p0c_field, p1c_field = get_price_fields()
-
-    df_p0c = df_filtered[df_filtered['_field'] == p0c_field]
-    df_p0c = df_p0c.sort_values(by='_time', ignore_index=True)
-
-    df_p1c = df_filtered[df_filtered['_field'] == p1c_field]
-    df_p1c = df_p1c.sort_values(by='_time', ignore_index=True)
+    pcs = []
+    for field in get_price_fields():
+        # Filter on the price field server side; one query per field means
+        # the result never needs to be split into p0c and p1c series
+        query = f'''
+            from(bucket:"{bucket}") |> range(start: -{points}d)
+                |> filter(fn: (r) => r["id"] == "{qid}")
+                |> filter(fn: (r) => r["_field"] == "{field}")
+                |> keep(columns: ["_time", "_field", "_value"])
+                |> group()
+        '''
+        # Ungrouped into a single table, so a single dataframe is returned
+        df = query_api.query_data_frame(query=query, org=org)
+        pcs.append(get_price_series(df))
 
     # Get the last timestamp
-    timestamp = datetime.timestamp(df_p0c['_time'][len(df_p0c['_time'])-1])
+    timestamp = pcs[0].t[-1]
 
-    return timestamp, [df_p0c, df_p1c]
+    return timestamp, pcs
 
 
 def compute_amount_out(twap_112: np.ndarray, amount_in: int) -> np.ndarray:
@@ -225,22 +249,22 @@ def compute_amount_out(twap_112: np.ndarray, amount_in: int) -> np.ndarray:
     Outputs:
       [np.ndarray]:
     '''
-    rshift = np.vectorize(lambda x: int(x * amount_in) >> PC_RESOLUTION)
-    return rshift(twap_112)
+    # float64 holds the product (~2**172 for 1e18 units) without overflow and
+    # dividing by 2**112 is exact, so flooring matches the integer shift
+    amounts_112 = np.asarray(twap_112, dtype=np.float64) * float(amount_in)
+    return np.floor(amounts_112 / (1 << PC_RESOLUTION))
 
 
-def get_twap(pc: pd.DataFrame, q: tp.Dict, p: tp.Dict) -> pd.DataFrame:
+def get_twap(pc: PriceSeries, q: tp.Dict, p: tp.Dict) -> pd.DataFrame:
     '''
     Calculates the rolling Time Weighted Average Price (TWAP) values for each
-    (`_time`, `_value`) row in the `priceCumulatives` dataframe. Rolling TWAP
-    values are calculated with a window size of `params['window']`.
+    (`t`, `v`) pair in the `priceCumulatives` series. Rolling TWAP values are
+    calculated with a window size of `params['window']`.
 
     Inputs:
-      pc  [pf.DataFrame]:  `priceCumulatives`
-        _time  [int]:  Unix timestamp
-        _field [str]:  Price cumulative field, `price0Cumulative` or
-                       `price1Cumulatives`
-        _value [int]:  Price cumulative field at unix timestamp `_time`
+      pc  [PriceSeries]:  `priceCumulatives`
+        t  [np.ndarray]:  Unix timestamps
+        v  [np.ndarray]:  Price cumulative field at unix timestamps `t`
 
       q          [tp.Dict]:   Quote pair entry fetched from SushiSwap
         id         [str]:   Name of swap pair
@@ -267,45 +291,33 @@ def get_twap(pc: pd.DataFrame, q: tp.Dict, p: tp.Dict) -> pd.DataFrame:
     '''
     window = p['window']
 
-    dp = pc.filter(items=['_value'])\
-        .rolling(window=window)\
-        .apply(lambda w: w[-1] - w[0], raw=True)
-
-    # for time, need to map to timestamp first then apply delta
-    dt = pc.filter(items=['_time'])\
-        .applymap(datetime.timestamp)\
-        .rolling(window=window)\
-        .apply(lambda w: w[-1] - w[0], raw=True)
+    # Deltas across a window of `window` rows, i.e. `w[-1] - w[0]`
+    lag = window - 1
+    size = max(len(pc.t) - lag, 0)
 
-    # Filter out NaNs
-    twap_112 = (dp['_value'] / dt['_time']).to_numpy()
-    twap_112 = twap_112[np.logical_not(np.isnan(twap_112))]
-    twaps = compute_amount_out(twap_112, q['amount_in'])
+    dp = pc.v[lag:] - pc.v[:size]
+    dt = pc.t[lag:] - pc.t[:size]
 
-    window_times = dt['_time'].to_numpy()
-    window_times = window_times[np.logical_not(np.isnan(window_times))]
+    twap_112 = dp / dt
 
     # Window close timestamps
-    t = pc.filter(items=['_time'])\
-        .applymap(datetime.timestamp)\
-        .rolling(window=window)\
-        .apply(lambda w: w[-1], raw=True)
+    ts = pc.t[lag:]
 
-    ts = t['_time'].to_numpy()
-    ts = ts[np.logical_not(np.isnan(ts))]
+    # Filter out NaNs (zero-length windows) with one mask so rows stay aligned
+    ok = np.logical_not(np.isnan(twap_112))
+    twaps = compute_amount_out(twap_112[ok], q['amount_in'])
 
-    df = pd.DataFrame(data=[ts, window_times, twaps]).T
-    df.columns = ['timestamp', 'window', 'twap']
+    df = pd.DataFrame({'timestamp': ts[ok], 'window': dt[ok], 'twap': twaps})
 
     # Filter out any TWAPs that are less than or equal to 0;
     # TODO: Why? Ingestion from sushi?
-    df = df[df['twap'] > 0]
+    df = df.loc[df['twap'].to_numpy() > 0]
 
     return df
 
 
 def get_twaps(
-        pcs: tp.List[pd.DataFrame],
+        pcs: tp.List[PriceSeries],
         q: tp.Dict,
         p: tp.Dict) -> tp.List[pd.DataFrame]:
     return [get_twap(pc, q, p) for pc in pcs]
@@ -319,12 +331,13 @@ def get_samples_from_twaps(
 # Calcs VaR * d^n normalized for initial imbalance
 # See: https://oips.overlay.market/notes/note-4
 def calc_vars(alpha: float, beta: float, sigma: float, mu: float, t: int,
-              n: int, alphas: np.ndarray) -> np.ndarray:
+              ns: np.ndarray, alphas: np.ndarray) -> np.ndarray:
     '''
     Calculates bracketed term:
         [e**(mu * n * t + sqrt(sig_sqrd * n * t) * Psi^{-1}(1 - alpha))]
-    in Value at Risk (VaR) expressions for each alpha value in the `alphas`
-    numpy array. SEE: https://oips.overlay.market/notes/note-4
+    in Value at Risk (VaR) expressions for each n value in the `ns` numpy
+    array and each alpha value in the `alphas` numpy array.
+    SEE: https://oips.overlay.market/notes/note-4
 
     Inputs:
       alpha   [float]:       alpha parameter from fit
@@ -332,11 +345,12 @@ def calc_vars(alpha: float, beta: float, sigma: float, mu: float, t: int,
       sigma   [float]:       sigma parameter from fit
       mu      [float]:       mu parameter from fit
       t       [int]:         period
-      n       [int]:
+      ns      [np.ndarray]:  array of number of periods into the future
       alphas  [np.ndarray]:  array of alphas
 
     Outputs:
-      [np.ndarray]:  Array of calculated values for each `alpha`
+      [np.ndarray]:  Array of calculated values of shape
+                     `(len(ns), len(alphas))`, one row per `n`
 
     '''
     q = 1 - np.array(alphas)
@@ -345,16 +359,17 @@ def calc_vars(alpha: float, beta: float, sigma: float, mu: float, t: int,
 
     sig = sigma * (t/alpha) ** (-1/alpha)
     mu = mu / t
-    pow = mu * n * t + sig * (n * t / alpha) ** (1 / alpha) * np.array(qtile)
+    nt = np.array(ns)[:, None] * t
+    pow = mu * nt + sig * (nt / alpha) ** (1 / alpha) * np.array(qtile)
     return np.exp(pow) - 1
 
 
 def get_stat(timestamp: int, sample: np.ndarray, p: tp.Dict
-             ) -> pd.DataFrame:
+             ) -> tp.Dict:
     t = p["period"]
 
     # mles
-    rs = [np.log(sample[i]/sample[i-1]) for i in range(1, len(sample), 1)]
+    rs = np.log(sample[1:] / sample[:-1])
 
     # Gaussian Fit
     fit = {'alpha': 2, 'beta': 0, 'sigma': 1, 'mu': 0, 'parameterization': 1}
@@ -370,95 +385,133 @@ def get_stat(timestamp: int, sample: np.ndarray, p: tp.Dict
     # VaRs for 5%, 1%, 0.1%, 0.01% alphas, n periods into the future
     alphas = np.array(p["alpha"])
     ns = np.array(p["n"])
-    vars = [calc_vars(fit_dist.contents.alpha, fit_dist.contents.beta,
-                      fit_dist.contents.sigma, fit_dist.contents.mu_1,
-                      t, n, alphas) for n in ns]
+    vars = calc_vars(fit_dist.contents.alpha, fit_dist.contents.beta,
+                     fit_dist.contents.sigma, fit_dist.contents.mu_1,
+                     t, ns, alphas)
     var_labels = [
         f'VaR alpha={alpha} n={n}'
         for n in ns
         for alpha in alphas
     ]
 
-    data = np.concatenate(([timestamp, fit_dist.contents.alpha,
-                            fit_dist.contents.beta, fit_dist.contents.sigma,
-                            fit_dist.contents.mu_1], *vars), axis=None)
-
-    df = pd.DataFrame(data=data).T
-    df.columns = ['timestamp', 'alpha', 'beta', 'sigma', 'mu', *var_labels]
-    return df
+    return {
+        'timestamp': float(timestamp),
+        'alpha': fit_dist.contents.alpha,
+        'beta': fit_dist.contents.beta,
+        'sigma': fit_dist.contents.sigma,
+        'mu': fit_dist.contents.mu_1,
+        **{label: float(var) for label, var in zip(var_labels, vars.ravel())}
+    }
 
 
 def get_stats(
         timestamp: int,
         samples: tp.List[np.ndarray],
-        p: tp.Dict) -> tp.List[pd.DataFrame]:
+        p: tp.Dict) -> tp.List[tp.Dict]:
     return [get_stat(timestamp, sample, p) for sample in samples]
 
 
+def process_quote(q: tp.Dict, config: tp.Dict, p: tp.Dict
+                  ) -> tp.List[Point]:
+    '''
+    Fetches price cumulatives for quote `q`, computes TWAPs and stats from
+    them and returns the points to write to the config `bucket`. Creates its
+    own InfluxDB client so it can run in a worker process.
+
+    Inputs:
+        q       [tp.Dict]:  Quote pair entry fetched from SushiSwap
+        config  [tp.Dict]:  Contains InfluxDB configuration parameters
+        p       [tp.Dict]:  Parameters to use in statistical estimates
+
+    Outputs:
+        [tp.List[Point]]:  One point per price cumulative, empty if the quote
+                           is skipped or fails
+    '''
+    print('id', q['id'])
+    points = []
+    client = create_client(config)
+    query_api = client.query_api()
+    try:
+        timestamp, pcs = get_price_cumulatives(query_api, config, q, p)
+        # Calculate difference between max and min date.
+        data_days = timedelta(seconds=pcs[0].t.max() - pcs[0].t.min())
+        print(
+            f"Number of days between latest and first "
+            f"data point: {data_days}"
+        )
+
+        if data_days < timedelta(days=p['points']-1):
+            print(
+                f"This pair has less than {p['points']-1} days of "
+                f"data, therefore it is not being ingested "
+                f"to {config['bucket']}"
+            )
+            return points
+
+        twaps = get_twaps(pcs, q, p)
+        print('timestamp', timestamp)
+        print('twaps', twaps)
+
+        # Calc stats for each twap (NOT inverse of each other)
+        samples = get_samples_from_twaps(twaps)
+        stats = get_stats(timestamp, samples, p)
+        print('stats', stats)
+
+        for i, stat in enumerate(stats):
+            token_name = q[f'token{i}_name']
+            point = Point("mem")\
+                .tag("id", q['id'])\
+                .tag('token_name', token_name)\
+                .tag("_type", f"price{i}Cumulative")\
+                .time(
+                    datetime.utcfromtimestamp(stat['timestamp']),
+                    WritePrecision.NS
+                )
+
+            for col, value in stat.items():
+                if col != 'timestamp':
+                    point = point.field(col, float(value))
+
+            points.append(point)
+
+    except Exception as e:
+        print("Failed to compute quote stats")
+        logging.exception(e)
+    finally:
+        client.close()
+
+    return points
+
+
 # SEE: get_params() for more info on setup
 def main():
     print("You are using data from the mainnet network")
     config = get_config()
     params = get_params()
     quotes = get_quotes()
+
+    # Quotes are independent, so fetch and compute them in parallel
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(
+            partial(process_quote, config=config, p=params), quotes)
+        points = [point for pts in results for point in pts]
+
     client = create_client(config)
-    query_api = client.query_api()
     write_api = client.write_api(
-        write_options=SYNCHRONOUS,
+        write_options=WriteOptions(
+            batch_size=500,
+            flush_interval=1000,
+            jitter_interval=0,
+            write_type=WriteType.batching,
+        ),
         point_settings=get_point_settings(),
     )
 
-    for q in quotes:
-        print('id', q['id'])
-        try:
-            timestamp, pcs = get_price_cumulatives(query_api, config, q,
-                                                   params)
-            # Calculate difference between max and min date.
-            data_days = pcs[0]['_time'].max() - pcs[0]['_time'].min()
-            print(
-                f"Number of days between latest and first "
-                f"data point: {data_days}"
-            )
-
-            if data_days < timedelta(days=params['points']-1):
-                print(
-                    f"This pair has less than {params['points']-1} days of "
-                    f"data, therefore it is not being ingested "
-                    f"to {config['bucket']}"
-                )
-                continue
-
-            twaps = get_twaps(pcs, q, params)
-            print('timestamp', timestamp)
-            print('twaps', twaps)
-
-            # Calc stats for each twap (NOT inverse of each other)
-            samples = get_samples_from_twaps(twaps)
-            stats = get_stats(timestamp, samples, params)
-            print('stats', stats)
-
-            for i, stat in enumerate(stats):
-                token_name = q[f'token{i}_name']
-                point = Point("mem")\
-                    .tag("id", q['id'])\
-                    .tag('token_name', token_name)\
-                    .tag("_type", f"price{i}Cumulative")\
-                    .time(
-                        datetime.utcfromtimestamp(float(stat['timestamp'])),
-                        WritePrecision.NS
-                    )
-
-                for col in stat.columns:
-                    if col != 'timestamp':
-                        point = point.field(col, float(stat[col]))
-
-                print(f"Writing {q['id']} for price{i}Cumulative to api ...")
-                write_api.write(config['bucket'], config['org'], point)
-
-        except Exception as e:
-            print("Failed to write quote stats to influx")
-            logging.exception(e)
+    print(f"Writing {len(points)} points to api ...")
+    write_api.write(config['bucket'], config['org'], points)
 
+    # Flush pending batches before closing the connection
+    write_api.close()
     client.close()
 
 
@@ -9,7 +9,9 @@ import math
 import time
 import gc
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache, partial
 
 from influxdb_client import InfluxDBClient, Point, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS, PointSettings
@@ -20,6 +22,13 @@ pd.set_option('display.max_columns', None)
 # Fixed point resolution of price cumulatives
 PC_RESOLUTION = 112
 
+# Quotes processed at once; each worker holds its quote's full history of
+# tick cumulatives and TWAPs in memory (Heroku R14)
+MAX_WORKERS = 2
+
+# Timestamps of points a worker accumulates before handing them to the writer
+POINTS_CHUNK = 500
+
 
 def get_config() -> tp.Dict:
     '''
@@ -110,13 +119,15 @@ def get_quote_path() -> str:
     return os.path.join(base, qp)
 
 
-def get_quotes() -> tp.List:
+@lru_cache(maxsize=1)
+def get_quotes() -> tp.Tuple:
     '''
-    Loads from `scripts/constants/quotes.json` and return a List
-    of quote dicts for quote data fetched from SushiSwap.
+    Loads from `scripts/constants/quotes.json` and return a Tuple
+    of quote dicts for quote data fetched from SushiSwap. The file is only
+    parsed once per process.
 
     Output:
-        [tp.List[dict]]
+        [tp.Tuple[dict]]
         id         [str]:   Name of swap pair
         pair       [str]:   Contract address of swap pair
         token0     [str]:   Contract address of token 0 in swap pair
@@ -129,12 +140,10 @@ def get_quotes() -> tp.List:
                             `priceCumulative1` storage variable
         amount_in  [float]:  Swap input amount
     '''
-    quotes = []
     p = get_quote_path()
     with open(p) as f:
         data = json.load(f)
-        quotes = data.get('quotes', [])
-    return quotes
+    return tuple(data.get('quotes', []))
 
 
 def get_price_fields() -> (str, str):
@@ -219,7 +228,7 @@ def get_price_cumulatives(
         q: tp.Dict,
         p: tp.Dict,
         start_time: int,
-        end_time: int) -> (int, tp.List[pd.DataFrame]):
+        end_time: int) -> (int, tp.List[pd.DataFrame], tp.List[bool]):
     '''
     Fetches `historical time series of priceCumulative` values for the last
     `params['points']` number of days for id `quote['id']` from the config
@@ -259,14 +268,14 @@ def get_price_cumulatives(
           timestamp          [int]:               Most recent timestamp of data
                                                   in `priceCumulative`
                                                   dataframes
-          priceCumulatives0  [pandas.DataFrame]:
+          tickCumulatives    [tp.List[pandas.DataFrame]]:  The same frame
+                                                           once per price
             _time  [int]:  Unix timestamp
-            _field [str]:  Price field, `price0Cumulative`
-            _value [int]:  `priceCumulative0` at unix timestamp `_time`
-          priceCumulatives1  [pandas.DataFrame]:
-            _time  [int]:  Unix timestamp
-            _field [str]:  Price field, `price1Cumulative`
-            _value [int]:  `priceCumulative1` at unix timestamp `_time`
+            _field [str]:  Tick field, `tick_cumulative`
+            _value [int]:  `tick_cumulative` at unix timestamp `_time`
+          inverts            [tp.List[bool]]:  Whether `get_twap` inverts the
+                                               TWAP for each frame, giving
+                                               price0 then price1
     '''
     qid = q['id']
     points = p['points']
@@ -282,74 +291,78 @@ def get_price_cumulatives(
             |> filter(fn: (r) => r["_measurement"] == "mem")
             |> filter(fn: (r) => r["_field"] == "tick_cumulative")
             |> filter(fn: (r) => r["id"] == "{qid}")
+            |> group()
+            |> sort(columns: ["_time"])
             |> keep(columns: ["_time", "_field", "_value"])
     '''
+    # Single table, already filtered and time ordered
     df = query_api.query_data_frame(query=query, org=org)
-    if type(df) == list:
-        df = pd.concat(df, ignore_index=True)
-
-    # Filter then separate the df into p0c and p1c dataframes
-    df_filtered = df.filter(items=['_time', '_field', '_value'])
-    pc_field = get_price_fields()
-
-    df_p0c = df_filtered[df_filtered['_field'] == pc_field]
-    df_p0c.loc[:, '_field'] = 'tick_cumulative0'
-    df_p0c = df_p0c.sort_values(by='_time', ignore_index=True)
-
-    df_p1c = df_p0c.copy()
-    df_p1c.loc[:, '_field'] = 'tick_cumulative1'
-    df_p1c.loc[:, '_value'] = df_p0c.loc[:, '_value']
+    # Tick cumulatives are integers on chain; keep their differences exact
+    df['_value'] = df['_value'].astype(np.int64)
 
     # Get the last timestamp
-    timestamp = datetime.timestamp(df_p0c['_time'][len(df_p0c['_time'])-1])
+    timestamp = datetime.timestamp(df['_time'][len(df['_time'])-1])
 
-    return timestamp, [df_p0c, df_p1c]
+    # Both prices come from the same ticks, price1 being the inverse of price0
+    return timestamp, [df, df], [False, True]
 
 
 def dynamic_window(
         df: pd.DataFrame,
         max_rows: int,
-        window: int
+        window: int,
+        period: int = None
         ) -> pd.DataFrame:
     '''
     Computes the window size in terms of rows such that there is as much data
     as there are seconds specified in the `window` variable.
-    '''
 
-    for i in range(1, int(max_rows+1)):
-        df.loc[:, 'lag_time'] = df.loc[:, '_time'].shift(i)
-        df.loc[:, i] =\
-            (pd.to_datetime(df.loc[:, '_time'])
-             - pd.to_datetime(df.loc[:, 'lag_time']))\
-            .dt.total_seconds()
-        df.loc[:, i] = abs(df.loc[:, i] - (window * 60))
-
-        df.drop(['lag_time'], axis=1, inplace=True)
-
-    min_df = df[[i for i in range(1, int(max_rows+1))]]\
-        .idxmin(axis="columns")
-
-    df.dropna(inplace=True)
-    df = df.join(pd.DataFrame(min_df, columns=['dynamic_window']))
-    df['dynamic_window'] = df['dynamic_window'].astype(int)
-    return df
-
-
-def delta_window(
-        row: pd.Series,
-        values: pd.Series,
-        lookback: pd.Series
-        ) -> pd.Series:
-    '''
-    Computes difference based on window sizes specified in `lookback`
+    When `period` is given and `window` is a multiple `k` of it, rows whose
+    last `k+1` steps are all close enough to `period` take `k` directly and
+    only the remaining rows are searched.
     '''
 
-    loc = values.index.get_loc(row.name)
-    lb = lookback.loc[row.name]
-    return values.iloc[loc] - values.iloc[loc-lb]
+    # Parsed once; lookbacks are compared in integer nanoseconds
+    t = pd.to_datetime(df['_time']).values.view('int64')
+    window_ns = window * 60 * 10**9
+
+    rows = np.arange(max_rows, len(t))
+    best = np.zeros(len(rows), dtype=np.int64)
+
+    # On a locally regular `period` grid the lookback closest to `window` is
+    # `k` rows: with each of the last `k+1` steps within `d` of `period`, row
+    # `k` is off by at most `k*d` and its neighbours by at least
+    # `period - (k+1)*d`
+    search = np.ones(len(rows), dtype=bool)
+    if period and window % period == 0 and 0 < window // period < max_rows:
+        k = window // period
+        period_ns = period * 60 * 10**9
+        dev = pd.Series(np.abs(np.diff(t) - period_ns))
+        # Largest deviation over the `k+1` steps ending at each row
+        d = dev.rolling(k + 1).max().to_numpy()[rows - 1]
+        search = ~((2*k + 1) * d < period_ns)
+        best[~search] = k
+
+    # Running argmin over lookbacks of 1 to `max_rows` rows for the remaining
+    # rows, keeping the smallest lookback on ties
+    rows = rows[search]
+    t_rows = t[rows]
+    found = np.zeros(len(rows), dtype=np.int64)
+    best_err = np.full(len(rows), np.iinfo(np.int64).max)
+    for i in range(1, max_rows + 1):
+        err = np.abs(t_rows - t[rows - i] - window_ns)
+        closer = err < best_err
+        found[closer] = i
+        best_err[closer] = err[closer]
+    best[search] = found
+
+    df = df.iloc[max_rows:].copy()
+    df['dynamic_window'] = best
+    return df
 
 
-def get_twap(pc: pd.DataFrame, q: tp.Dict, p: tp.Dict) -> pd.DataFrame:
+def get_twap(pc: pd.DataFrame, q: tp.Dict, p: tp.Dict,
+             invert: bool = False) -> pd.DataFrame:
     window = p['window']
     period = p['period']
     tolerance = p['tolerance']
@@ -358,54 +371,52 @@ def get_twap(pc: pd.DataFrame, q: tp.Dict, p: tp.Dict) -> pd.DataFrame:
 
     max_rows = ((window/period)+1) * 2
 
-    pc = dynamic_window(pc, int(max_rows), int(window))
-    pc['dp'] = pc.apply(
-            delta_window,
-            values=pc['_value'],
-            lookback=pc['dynamic_window'],
-            axis=1)
-    pc['dt'] = pc.apply(
-            delta_window,
-            values=pc['_time'],
-            lookback=pc['dynamic_window'],
-            axis=1).dt.total_seconds()
+    pc = dynamic_window(pc, int(max_rows), int(window), int(period))
+
+    # Differences over each row's `dynamic_window` lookback, keeping only rows
+    # whose lookback starts within the dataframe
+    end = np.arange(len(pc))
+    start = end - pc['dynamic_window'].to_numpy()
+    valid = start >= 0
+    end, start = end[valid], start[valid]
+
+    values = pc['_value'].to_numpy()
+    times = pc['_time'].values
+    pc = pc[valid].copy()
+    pc['dp'] = values[end] - values[start]
+    pc['dt'] = (times[end] - times[start]) / np.timedelta64(1, 's')
 
     pc = pc[(pc['dt'] > 0)]
     pc = pc[((pc['dt'] <= upper_limit) & (pc['dt'] >= lower_limit))]
     pc.reset_index(inplace=True)
-    # with NaNs filtered out
-    log_p = pc['dp'] / pc['dt']
-    twap_112 = (log_p.apply(lambda x: np.power(1.0001, x))).to_numpy()
-    twaps = twap_112[np.logical_not(np.isnan(twap_112))]
-    if pc.loc[0, '_field'] == 'tick_cumulative1':
+    log_p = (pc['dp'] / pc['dt']).to_numpy()
+    twaps = np.power(1.0001, log_p)
+    if invert:
         twaps = 1/twaps
 
     # window times
     window_times = pc['dt'].to_numpy()
-    window_times = window_times[np.logical_not(np.isnan(window_times))]
 
     # window close timestamps
-    t = pc.filter(items=['_time'])\
-        .applymap(datetime.timestamp)\
-        .rolling(window=1)\
-        .apply(lambda w: w[-1], raw=True)
-    ts = t['_time'].to_numpy()
-    ts = ts[np.logical_not(np.isnan(ts))]
-
-    df = pd.DataFrame(data=[ts, window_times, twaps]).T
-    df.columns = ['timestamp', 'window', 'twap']
+    ts = pc['_time'].values.view('int64') / 1e9
 
-    # filter out any twaps that are less than or equal to 0;
+    # one mask keeps the columns aligned: filter out NaNs and any twaps that
+    # are less than or equal to 0;
     # TODO: why? injestion from sushi?
-    df = df[df['twap'] > 0]
-    return df
+    ok = np.isfinite(twaps) & np.isfinite(window_times) & (twaps > 0)
+    return pd.DataFrame({
+        'timestamp': ts[ok],
+        'window': window_times[ok],
+        'twap': twaps[ok],
+    })
 
 
 def get_twaps(
         pcs: tp.List[pd.DataFrame],
         q: tp.Dict,
-        p: tp.Dict) -> tp.List[pd.DataFrame]:
-    return [get_twap(pc, q, p) for pc in pcs]
+        p: tp.Dict,
+        inverts: tp.List[bool]) -> tp.List[pd.DataFrame]:
+    return [get_twap(pc, q, p, invert) for pc, invert in zip(pcs, inverts)]
 
 
 def get_samples_from_twaps(
@@ -416,12 +427,13 @@ def get_samples_from_twaps(
 # Calcs VaR * d^n normalized for initial imbalance
 # See: https://oips.overlay.market/notes/note-4
 def calc_vars(alpha: float, beta: float, sigma: float, mu: float, t: int,
-              n: int, qtile: np.ndarray) -> np.ndarray:
+              ns: np.ndarray, qtile: np.ndarray) -> np.ndarray:
     '''
     Calculates bracketed term:
         [e**(mu * n * t + sqrt(sig_sqrd * n * t) * Psi^{-1}(1 - alpha))]
-    in Value at Risk (VaR) expressions for each alpha value in the `alphas`
-    numpy array. SEE: https://oips.overlay.market/notes/note-4
+    in Value at Risk (VaR) expressions for each n value in the `ns` numpy
+    array and each alpha quantile in the `qtile` numpy array.
+    SEE: https://oips.overlay.market/notes/note-4
 
     Inputs:
       alpha   [float]:       alpha parameter from fit
@@ -429,17 +441,19 @@ def calc_vars(alpha: float, beta: float, sigma: float, mu: float, t: int,
       sigma   [float]:       sigma parameter from fit
       mu      [float]:       mu parameter from fit
       t       [int]:         period
-      n       [int]:
-      alphas  [np.ndarray]:  array of alphas
+      ns      [np.ndarray]:  array of number of periods into the future
+      qtile   [np.ndarray]:  quantiles of the fit at `1 - alphas`
 
     Outputs:
-      [np.ndarray]:  Array of calculated values for each `alpha`
+      [np.ndarray]:  Array of calculated values of shape
+                     `(len(ns), len(qtile))`, one row per `n`
 
     '''
 
     sig = sigma * (t/alpha) ** (-1/alpha)
     mu = mu / t
-    pow = mu * n * t + sig * (n * t / alpha) ** (1 / alpha) * np.array(qtile)
+    nt = np.array(ns)[:, None] * t
+    pow = mu * nt + sig * (nt / alpha) ** (1 / alpha) * np.array(qtile)
     return np.exp(pow) - 1
 
 
@@ -448,7 +462,7 @@ def get_stat(timestamp: int, sample: np.ndarray, p: tp.Dict
     t = p["period"] * 60
 
     # mles
-    rs = [np.log(sample[i]/sample[i-1]) for i in range(1, len(sample), 1)]
+    rs = np.diff(np.log(np.asarray(sample, dtype=np.float64)))
 
     # Gaussian Fit
     fit = {'alpha': 2, 'beta': 0, 'sigma': 1, 'mu': 0, 'parameterization': 1}
@@ -466,9 +480,9 @@ def get_stat(timestamp: int, sample: np.ndarray, p: tp.Dict
                                  fit_dist.contents.beta, 1, 0, 1)
     q = 1 - np.array(alphas)
     qtile = pystable.q(scale_dist, q, len(q))
-    vars = [calc_vars(fit_dist.contents.alpha, fit_dist.contents.beta,
-                      fit_dist.contents.sigma, fit_dist.contents.mu_1,
-                      t, n, qtile) for n in ns]
+    vars = calc_vars(fit_dist.contents.alpha, fit_dist.contents.beta,
+                     fit_dist.contents.sigma, fit_dist.contents.mu_1,
+                     t, ns, qtile)
     var_labels = [
         f'VaR alpha={alpha} n={n}'
         for n in ns
@@ -477,7 +491,8 @@ def get_stat(timestamp: int, sample: np.ndarray, p: tp.Dict
 
     data = np.concatenate(([timestamp, fit_dist.contents.alpha,
                             fit_dist.contents.beta, fit_dist.contents.sigma,
-                            fit_dist.contents.mu_1], *vars), axis=None)
+                            fit_dist.contents.mu_1], vars.ravel()),
+                          axis=None)
 
     df = pd.DataFrame(data=data).T
     df.columns = ['timestamp', 'alpha', 'beta', 'sigma', 'mu', *var_labels]
@@ -491,107 +506,149 @@ def get_stats(
     return [get_stat(timestamp, sample, p) for sample in samples]
 
 
-# SEE: get_params() for more info on setup
-def main():
-    config = get_config()
-    params = get_params()
-    quotes = get_quotes()
+def process_quote(q: tp.Dict, config: tp.Dict, params: tp.Dict) -> int:
+    '''
+    Computes TWAP stats for quote `q` at each timestamp of the source bucket
+    not yet ingested to the config `bucket`, and writes them to `bucket` every
+    `POINTS_CHUNK` timestamps. Creates its own InfluxDB client so it can run
+    in a worker process.
+
+    Inputs:
+        q       [tp.Dict]:  Quote pair entry fetched from UniswapV3
+        config  [tp.Dict]:  Contains InfluxDB configuration parameters
+        params  [tp.Dict]:  Parameters to use in statistical estimates
+
+    Outputs:
+        [int]:  Number of points stored, two per timestamp, one per price
+                cumulative; 0 if the quote is up to date, skipped or fails
+                before its first chunk is stored
+    '''
+    print('id', q['id'])
+    written = 0
+    points = []
     client = create_client(config)
     query_api = client.query_api()
+    # One synchronous request per chunk, so a failed write raises before the
+    # quote moves past it and `find_start` resumes from the last stored point
     write_api = client.write_api(
         write_options=SYNCHRONOUS,
         point_settings=get_point_settings(),
     )
+    try:
+        start_ts = find_start(query_api, q, config, params)
+        ts_list = list_of_timestamps(query_api, q, config, start_ts)
+        if ts_list[0] == 0:
+            return written
+        first_ts, last_ts = ts_list[0], ts_list[len(ts_list)-1]
+        _, pcs_all, inverts = get_price_cumulatives(query_api,
+                                                    config,
+                                                    q,
+                                                    params,
+                                                    first_ts,
+                                                    last_ts)
+
+        try:
+            # Calculate difference between max and min date.
+            data_days = pcs_all[0]['_time'].max()\
+                        - pcs_all[0]['_time'].min()
+
+            if data_days < timedelta(days=params['points']-1):
+                print(
+                    f"The pair has less than {params['points']-1}d of"
+                    f"data, therefore it is not being ingested"
+                    f"to {config['bucket']}"
+                )
+                return written
+
+            twaps_all = get_twaps(pcs_all, q, params, inverts)
+
+        except Exception as e:
+            print("Failed to generate TWAPs")
+            logging.exception(e)
+            return written
+
+        loop_counter = 0
+        try:
+            for ts in ts_list:
+                loop_counter += 1
+                timestamp = int(ts.timestamp())
+                print('timestamp: ', datetime.fromtimestamp(timestamp))
+                end_twap = ts.timestamp()
+                lookb_wndw = params['points']*24*60*60
+                start_twap = (ts-timedelta(seconds=lookb_wndw)).timestamp()
+                twaps =\
+                    [
+                     twaps_all[0][(twaps_all[0].timestamp >= start_twap)
+                                  & (twaps_all[0].timestamp <= end_twap)],
+                     twaps_all[1][(twaps_all[1].timestamp >= start_twap)
+                                  & (twaps_all[1].timestamp <= end_twap)]
+                    ]
+                samples = get_samples_from_twaps(twaps)
+                stats = get_stats(timestamp, samples, params)
+                for i, stat in enumerate(stats):
+                    token_name = q[f'token{i}_name']
+                    point = Point("mem")\
+                        .tag("id", q['id'])\
+                        .tag('token_name', token_name)\
+                        .tag("_type", f"price{i}Cumulative")\
+                        .time(
+                            datetime.utcfromtimestamp(
+                                    float(stat['timestamp'])
+                                    ),
+                            WritePrecision.NS
+                        )
+
+                    for col in stat.columns:
+                        if col != 'timestamp':
+                            point = point.field(col, float(stat[col]))
+
+                    points.append(point)
+
+                if loop_counter >= POINTS_CHUNK:
+                    # write points and release memory
+                    # periodically to avoid R14 error (Heroku)
+                    write_api.write(config['bucket'], config['org'], points)
+                    written += len(points)
+                    points = []
+                    del twaps
+                    del samples
+                    del stats
+                    del stat
+                    gc.collect()
+                    print("Memory freed up")
+                    loop_counter = 0
+
+            if points:
+                write_api.write(config['bucket'], config['org'], points)
+                written += len(points)
+
+        except Exception as e:
+            print("Failed to compute or write quote stats")
+            logging.exception(e)
+
+        del twaps_all
+        gc.collect()
+
+    finally:
+        client.close()
+
+    return written
+
+
+# SEE: get_params() for more info on setup
+def main():
+    config = get_config()
+    params = get_params()
+    quotes = get_quotes()
 
     while True:
-        for q in quotes:
-            print('id', q['id'])
-            start_ts = find_start(query_api, q, config, params)
-            ts_list = list_of_timestamps(query_api, q, config, start_ts)
-            if ts_list[0] == 0:
-                continue
-            first_ts, last_ts = ts_list[0], ts_list[len(ts_list)-1]
-            _, pcs_all = get_price_cumulatives(query_api,
-                                               config,
-                                               q,
-                                               params,
-                                               first_ts,
-                                               last_ts)
-
-            try:
-                # Calculate difference between max and min date.
-                data_days = pcs_all[0]['_time'].max()\
-                            - pcs_all[0]['_time'].min()
-
-                if data_days < timedelta(days=params['points']-1):
-                    print(
-                        f"The pair has less than {params['points']-1}d of"
-                        f"data, therefore it is not being ingested"
-                        f"to {config['bucket']}"
-                    )
-                    continue
-
-                twaps_all = get_twaps(pcs_all, q, params)
-
-            except Exception as e:
-                print("Failed to generate TWAPs")
-                logging.exception(e)
-
-            loop_counter = 0
-            try:
-                for ts in ts_list:
-                    loop_counter += 1
-                    timestamp = int(ts.timestamp())
-                    print('timestamp: ', datetime.fromtimestamp(timestamp))
-                    end_twap = ts.timestamp()
-                    lookb_wndw = params['points']*24*60*60
-                    start_twap = (ts-timedelta(seconds=lookb_wndw)).timestamp()
-                    twaps =\
-                        [
-                         twaps_all[0][(twaps_all[0].timestamp >= start_twap)
-                                      & (twaps_all[0].timestamp <= end_twap)],
-                         twaps_all[1][(twaps_all[1].timestamp >= start_twap)
-                                      & (twaps_all[1].timestamp <= end_twap)]
-                        ]
-                    samples = get_samples_from_twaps(twaps)
-                    stats = get_stats(timestamp, samples, params)
-                    for i, stat in enumerate(stats):
-                        token_name = q[f'token{i}_name']
-                        point = Point("mem")\
-                            .tag("id", q['id'])\
-                            .tag('token_name', token_name)\
-                            .tag("_type", f"price{i}Cumulative")\
-                            .time(
-                                datetime.utcfromtimestamp(
-                                        float(stat['timestamp'])
-                                        ),
-                                WritePrecision.NS
-                            )
-
-                        for col in stat.columns:
-                            if col != 'timestamp':
-                                point = point.field(col, float(stat[col]))
-
-                        print(f"Writing {q['id']} for price{i}Cumulative...")
-                        write_api.write(config['bucket'], config['org'], point)
-
-                    if loop_counter > 500:
-                        # release memory periodically
-                        # to avoid R14 error (Heroku)
-                        del twaps
-                        del samples
-                        del stats
-                        del stat
-                        gc.collect()
-                        print("Memory freed up")
-                        loop_counter = 0
-
-            except Exception as e:
-                print("Failed to write quote stats to influx")
-                logging.exception(e)
-
-            del twaps_all
-            gc.collect()
+        # Quotes are independent, so fetch, compute and write a few of them
+        # in parallel
+        with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            results = executor.map(
+                partial(process_quote, config=config, params=params), quotes)
+            for q, written in zip(quotes, results):
+                print(f"Stored {written} points for {q['id']}")
 
         print("Metrics are up to date. Wait 5 mins.")
         time.sleep(300)
@@ -5,22 +5,50 @@ import json
 import typing as tp
 import time
 import math
+import logging
 import requests
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 from brownie import network, Contract
 from datetime import datetime, timedelta
 
 from influxdb_client import InfluxDBClient
-from influxdb_client.client.write_api import SYNCHRONOUS, PointSettings
+from influxdb_client.client.write_api import PointSettings, WriteOptions
 
 BLOCK_SUBGRAPH_ENDPOINT = "https://api.thegraph.com/subgraphs/name/decentraland/blocks-ethereum-mainnet"  # noqa
-
-
-def get_b_q(timestamp: int) -> str:
-    return """query {
-                blocks(
+BLOCK_SUBGRAPH_BATCH = 100
+BLOCK_CACHE_SIZE = 100000
+BLOCK_SUBGRAPH_RETRIES = 5
+
+# (block, block timestamp) per lookup timestamp; the subgraph answer for a
+# given timestamp never changes
+_b_t_cache: tp.Dict[int, tp.Tuple] = {}
+
+# Keep-alive session for subgraph requests, retrying transient failures
+# with backoff
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(['POST']),
+    ),
+))
+
+
+def get_b_q(timestamps: tp.List[int]) -> str:
+    # One aliased `blocks` lookup per timestamp, so a single request
+    # resolves the whole batch
+    return "query {%s}" % "".join(
+        """
+                t%s: blocks(
                     first: 1,
                     orderBy: timestamp,
                     orderDirection: desc,
@@ -28,8 +56,9 @@ def get_b_q(timestamp: int) -> str:
                 ) {
                     timestamp
                     number
-                }
-            } """ % (str(timestamp))
+                }""" % (str(timestamp), str(timestamp))
+        for timestamp in timestamps
+    )
 
 
 def get_config() -> tp.Dict:
@@ -38,7 +67,7 @@ def get_config() -> tp.Dict:
         "org": os.getenv('INFLUXDB_ORG'),
         "bucket": os.getenv('INFLUXDB_BUCKET', 'ovl_univ3_1m'),
         "url": os.getenv("INFLUXDB_URL"),
-        "window": os.getenv("WINDOW", 60)
+        "window": int(os.getenv("WINDOW", 60))
     }
 
 
@@ -67,13 +96,12 @@ def get_quote_path() -> str:
     return os.path.join(base, qp)
 
 
-def get_quotes() -> tp.List:
-    quotes = []
+@lru_cache(maxsize=1)
+def get_quotes() -> tp.Tuple:
     p = get_quote_path()
     with open(p) as f:
         data = json.load(f)
-        quotes = data.get('quotes', [])
-    return quotes
+    return tuple(data.get('quotes', []))
 
 
 def get_uni_abi_path() -> str:
@@ -81,26 +109,31 @@ def get_uni_abi_path() -> str:
     return os.path.join(base, 'constants/univ3.abi.json')
 
 
+@lru_cache(maxsize=1)
 def get_uni_abi() -> tp.Dict:
     with open(get_uni_abi_path()) as f:
         data = json.load(f)
     return data
 
 
-def get_b_t(timestamp: int) -> tp.Tuple:
+def get_b_t(timestamps: tp.List[int]) -> tp.List[tp.Tuple]:
 
-    q = {'query': get_b_q(timestamp)}
+    timestamps = [int(t) for t in timestamps]
+    q = {'query': get_b_q(timestamps)}
 
+    # The session retries transport failures; a 200 response can still carry
+    # GraphQL `errors` without `data`, or an empty `blocks` alias
     retries = 1
-    success = False
-
-    while not success and retries < 5:
+    while True:
+        r = _session.post(BLOCK_SUBGRAPH_ENDPOINT, json=q, timeout=10)
+        r.raise_for_status()
         try:
-            result = json.loads(
-                requests.post(BLOCK_SUBGRAPH_ENDPOINT, json=q).text
-            )['data']['blocks'][0]
-            success = True
-        except Exception as e:
+            data = r.json()['data']
+            result = [data[f't{t}'][0] for t in timestamps]
+            break
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            if retries >= BLOCK_SUBGRAPH_RETRIES:
+                raise
             wait = retries * 10
             err_cls = e.__class__
             err_msg = str(e)
@@ -113,7 +146,22 @@ def get_b_t(timestamp: int) -> tp.Tuple:
             time.sleep(wait)
             retries += 1
 
-    return (int(result['number']), int(result['timestamp']))
+    return [(int(b['number']), int(b['timestamp'])) for b in result]
+
+
+def get_b_ts(timestamps: tp.List[int]) -> tp.List[tp.Tuple]:
+    # Resolve uncached blocks `BLOCK_SUBGRAPH_BATCH` timestamps per subgraph
+    # request
+    timestamps = [int(t) for t in timestamps]
+    if len(_b_t_cache) > BLOCK_CACHE_SIZE:
+        _b_t_cache.clear()
+
+    missing = [t for t in dict.fromkeys(timestamps) if t not in _b_t_cache]
+    for i in range(0, len(missing), BLOCK_SUBGRAPH_BATCH):
+        batch = missing[i:i+BLOCK_SUBGRAPH_BATCH]
+        _b_t_cache.update(zip(batch, get_b_t(batch)))
+
+    return [_b_t_cache[t] for t in timestamps]
 
 
 def get_calls(
@@ -131,7 +179,8 @@ def get_calls(
     return calls
 
 
-def find_start(api, quote, config) -> int:
+def find_start(api, quotes, config) -> tp.Dict[str, int]:
+    # Last ingested timestamp of every quote, from a single query
 
     retries = 1
     success = False
@@ -141,9 +190,11 @@ def find_start(api, quote, config) -> int:
             r = api.query_data_frame(org=config['org'], query=f'''
                 from(bucket:"{config['bucket']}")
                     |> range(start:0, stop: now())
-                    |> filter(fn: (r) => r["id"] == "{quote['id']}")
                     |> filter(fn: (r) => r["_field"] == "tick_cumulative")
+                    |> group(columns: ["id"])
                     |> last()
+                    |> group()
+                    |> keep(columns: ["_time", "id"])
             ''')
             success = True
         except Exception as e:
@@ -159,28 +210,29 @@ def find_start(api, quote, config) -> int:
             time.sleep(wait)
             retries += 1
 
+    starts = {}
     if (len(r.index) > 0):
-        return math.floor(datetime.timestamp(
-            r.iloc[0]['_time']))
-    else:
-        # return quote['time_deployed'] + 1200
-        return math.floor(
-            int(datetime.timestamp(datetime.now() - timedelta(days=60)))
-            )
+        starts = {
+            row['id']: int(row['_time'].value // 10**9)
+            for _, row in r.iterrows()
+        }
+
+    # return quote['time_deployed'] + 1200
+    default = int(datetime.timestamp(datetime.now() - timedelta(days=60)))
+    return {q['id']: starts.get(q['id'], default) for q in quotes}
 
 
 def read_cumulatives(args: tp.Tuple) -> tp.Tuple:
 
-    (pair, t_at) = args
-    (b, b_t) = get_b_t(t_at)
+    (pair, b, b_t) = args
     (cum_tick, cum_liq) = pair.observe([0], block_identifier=b)
     return (b_t, cum_tick[0], cum_liq[0])
 
 
 def list_cumulatives(args: tp.Tuple) -> tp.Tuple:
 
-    (quote, pool, ts) = args
-    item = read_cumulatives((pool, ts))
+    (quote, pool, b, b_t) = args
+    item = read_cumulatives((pool, b, b_t))
     print("item", item)
     print('time', datetime.fromtimestamp(
                 item[0]).strftime("%m/%d/%Y, %H:%M:%S"))
@@ -219,55 +271,56 @@ def write_cumulatives(config, vals):
 
         print("Start ingestion")
 
+        errors = []
+
+        def on_error(conf, data, e):
+            print(f"Failed to write batch to {conf[0]}: {e}")
+            errors.append(e)
+
+        # The whole frame goes out as one batch, retried with exponential
+        # backoff by the client; closing the write api flushes it
         write_api = client.write_api(
-            write_options=SYNCHRONOUS, point_settings=get_point_settings())
-
-        j = 1
-        while j == 1:
-            try:
-                write_api.write(bucket=config['bucket'],
-                                record=df,
-                                data_frame_measurement_name="mem",
-                                data_frame_tag_columns=[
-                                    'id', 'token0_name', 'token1_name'
-                                    ]
-                                )
-                j = 0
-                print("Ingested to influxdb")
-            except Exception as e:
-                err_cls = e.__class__
-                err_msg = str(e)
-                msg = f'''
-                Error type = {err_cls}
-                Error message = {err_msg}
-                Wait 5 secs
-                '''
-                print(msg)
-                continue
-
-
-def get_uni_cumulatives(quotes, query_api, config, t_end):
-    abi = get_uni_abi()
+            write_options=WriteOptions(batch_size=max(len(df), 1),
+                                       flush_interval=2000,
+                                       retry_interval=5000,
+                                       max_retries=5,
+                                       max_retry_delay=30000,
+                                       exponential_base=2),
+            point_settings=get_point_settings(),
+            error_callback=on_error)
+
+        write_api.write(bucket=config['bucket'],
+                        record=df,
+                        data_frame_measurement_name="mem",
+                        data_frame_tag_columns=[
+                            'id', 'token0_name', 'token1_name'
+                            ]
+                        )
+        write_api.close()
+
+    # Raise so callers do not move past the window; `find_start` resumes from
+    # the last point actually written
+    if errors:
+        raise errors[0]
+    print("Ingested to influxdb")
+
+
+def get_uni_cumulatives(quotes, pools, query_api, config, t_end):
     t_step = 500
+    t_starts = find_start(query_api, quotes, config)
 
     for q in quotes:
 
-        pool = POOL(q['pair'], abi)
+        pool = pools[q['pair']]
         batch_size = (t_step * config['window'])
-        t_start = find_start(query_api, q, config)
+        t_start = t_starts[q['id']]
         t_interm = t_start + batch_size
         if t_interm > t_end:
             t_interm = t_end
 
         while t_start < t_end:
-            list_cumulatives_calls = [
-                (q, pool, x)
-                for x in np.arange(
-                    t_start,
-                    t_interm,
-                    config['window']
-                    )
-                ]
+            b_ts = get_b_ts(np.arange(t_start, t_interm, config['window']))
+            list_cumulatives_calls = [(q, pool, b, b_t) for (b, b_t) in b_ts]
 
             list_cumulatives_vals = []
             with ThreadPoolExecutor() as executor:
@@ -288,13 +341,21 @@ def main():
 
     config = get_config()
     quotes = get_quotes()
+    abi = get_uni_abi()
+    pools = {q['pair']: POOL(q['pair'], abi) for q in quotes}
     client = create_client(config)
     query_api = client.query_api()
 
-    t_end = math.floor(time.time())
     while True:
-        get_uni_cumulatives(quotes, query_api, config, t_end)
-        sl_time = config['window']
+        # Wake once per window, less the time spent ingesting
+        tick_start = time.time()
+        try:
+            get_uni_cumulatives(quotes, pools, query_api, config,
+                                math.floor(tick_start))
+        except Exception as e:
+            # Quotes resume from their last written point next tick
+            print("Failed to ingest cumulatives")
+            logging.exception(e)
+        sl_time = max(0, config['window'] - (time.time() - tick_start))
         print(f'Wait {sl_time} secs')
         time.sleep(sl_time)
-        t_end = math.floor(time.time())
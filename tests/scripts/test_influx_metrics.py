@@ -1,3 +1,4 @@
+import numpy.testing as np_testing
 import pandas as pd
 import pandas.testing as pd_testing
 import os
@@ -5,6 +6,7 @@ import unittest
 from unittest import mock
 from scripts import influx_metrics as imetrics
 import typing as tp
+from datetime import datetime
 
 
 class TestInfluxMetrics(unittest.TestCase):
@@ -65,6 +67,16 @@ class TestInfluxMetrics(unittest.TestCase):
 
         return [df_p0c, df_p1c]
 
+    def get_pc_series(self, df: pd.DataFrame) -> imetrics.PriceSeries:
+        '''
+        Helper to build the expected `PriceSeries` from a sorted price
+        cumulative dataframe
+        '''
+        return imetrics.PriceSeries(
+            t=df['_time'].map(datetime.timestamp).to_numpy(),
+            v=df['_value'].to_numpy(),
+        )
+
     @mock.patch('scripts.influx_metrics.InfluxDBClient')
     def test_create_client(self, mock_idb_client):
         '''
@@ -136,7 +148,7 @@ class TestInfluxMetrics(unittest.TestCase):
 
         actual = imetrics.get_quotes()
 
-        self.assertIsInstance(actual, tp.List)
+        self.assertIsInstance(actual, tp.Tuple)
 
         for i in actual:
             actual_keys = set(i.keys())
@@ -166,7 +178,11 @@ class TestInfluxMetrics(unittest.TestCase):
         path = 'influx-metrics/sushi/weth-wbtc'
         query_df = self.get_price_cumulatives_df(path)
         expected_pcs = self.get_pc_dfs(query_df)
-        mock_df.return_value = query_df
+        # One query per price field, filtered server side
+        mock_df.side_effect = [
+            query_df[query_df['_field'] == field]
+            for field in self.get_expected_price_fields()
+        ]
 
         config = {
             'token': 'INFLUXDB_TOKEN',
@@ -188,8 +204,10 @@ class TestInfluxMetrics(unittest.TestCase):
         actual_pcs = actual[1]
 
         self.assertEqual(expected_timestamp, actual_timestamp)
-        pd_testing.assert_frame_equal(expected_pcs[0], actual_pcs[0])
-        pd_testing.assert_frame_equal(expected_pcs[1], actual_pcs[1])
+        for expected_pc, actual_pc in zip(expected_pcs, actual_pcs):
+            expected_pc = self.get_pc_series(expected_pc)
+            np_testing.assert_array_equal(expected_pc.t, actual_pc.t)
+            np_testing.assert_array_equal(expected_pc.v, actual_pc.v)
 
     def test_compute_amount_out(self):
         pass
@@ -210,7 +228,7 @@ class TestInfluxMetrics(unittest.TestCase):
         """
         path = 'influx-metrics/sushi/weth-wbtc'
         query_df = self.get_price_cumulatives_df(path)
-        gpc_pcs = self.get_pc_dfs(query_df)
+        gpc_pcs = [self.get_pc_series(df) for df in self.get_pc_dfs(query_df)]
 
         params = imetrics.get_params()
         quotes = imetrics.get_quotes()
@@ -219,8 +237,6 @@ class TestInfluxMetrics(unittest.TestCase):
         # Price Cumulative 0
         pcs_idx = 0
         expected = self.get_twap_df(path, pcs_idx)
-        expected.timestamp = expected.timestamp.astype(object)
-        expected.window = expected.window.astype(object)
         expected.twap = expected.twap.astype(float)
         expected.columns = ['timestamp', 'window', 'twap']
 
@@ -271,7 +287,7 @@ class TestInfluxMetrics(unittest.TestCase):
         `params['n']`, where `n` represents number of time periods into the
         future estimate is relevant for.
 
-        Should return a pandas DataFrame with columns
+        Should return a dict with keys
 
         [`timestamp`, *mle_labels, *var_labels]
 
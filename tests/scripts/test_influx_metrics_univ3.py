@@ -3,6 +3,7 @@ Run using python from terminal.
 Doesn't read from scripts directory (L13) when run from poetry shell.
 '''
 
+import numpy as np
 import pandas as pd
 import pandas.testing as pd_testing
 import typing as tp
@@ -73,15 +74,11 @@ class TestInfluxMetrics(unittest.TestCase):
         '''
         df_filtered = df.filter(items=['_time', '_field', '_value'])
 
-        df_p0c = df_filtered[df_filtered['_field'] == 'tick_cumulative']
-        df_p0c = df_p0c.sort_values(by='_time', ignore_index=True)
-        df_p0c.loc[:, '_field'] = 'tick_cumulative0'
+        df_pc = df_filtered[df_filtered['_field'] == 'tick_cumulative']
+        df_pc = df_pc.sort_values(by='_time', ignore_index=True)
+        df_pc['_value'] = df_pc['_value'].astype(np.int64)
 
-        df_p1c = df_p0c.copy()
-        df_p1c.loc[:, '_field'] = 'tick_cumulative1'
-        df_p1c.loc[:, '_value'] = df_p0c.loc[:, '_value']
-
-        return [df_p0c, df_p1c]
+        return [df_pc, df_pc]
 
     @mock.patch('scripts.influx_metrics_univ3.InfluxDBClient')
     def test_create_client(self, mock_idb_client):
@@ -158,7 +155,7 @@ class TestInfluxMetrics(unittest.TestCase):
 
         actual = imetrics.get_quotes()
 
-        self.assertIsInstance(actual, tp.List)
+        self.assertIsInstance(actual, tp.Tuple)
 
         for i in actual:
             actual_keys = set(i.keys())
@@ -189,7 +186,12 @@ class TestInfluxMetrics(unittest.TestCase):
         end_time = 1636528398
         query_df = self.get_price_cumulatives_df(path)
         expected_pcs = self.get_pc_dfs(query_df)
-        mock_df.return_value = query_df
+
+        # Flux query filters, keeps and time orders rows server side
+        mock_df.return_value = query_df[
+            query_df['_field'] == 'tick_cumulative'
+        ].filter(items=['_time', '_field', '_value']).sort_values(
+            by='_time', ignore_index=True)
 
         config = {
             'token': 'INFLUXDB_TOKEN',
@@ -205,7 +207,7 @@ class TestInfluxMetrics(unittest.TestCase):
         quotes = imetrics.get_quotes()
         quote = quotes[0]
 
-        _, actual_pcs = imetrics.get_price_cumulatives(
+        _, actual_pcs, actual_inverts = imetrics.get_price_cumulatives(
                 query_api, config,
                 quote, params,
                 datetime.datetime.utcfromtimestamp(start_time),
@@ -214,6 +216,7 @@ class TestInfluxMetrics(unittest.TestCase):
 
         pd_testing.assert_frame_equal(expected_pcs[0], actual_pcs[0])
         pd_testing.assert_frame_equal(expected_pcs[1], actual_pcs[1])
+        self.assertEqual(actual_inverts, [False, True])
 
     @mock.patch('influxdb_client.client.query_api.QueryApi.query_data_frame')
     def test_find_start(self, mock_time):
@@ -296,6 +299,77 @@ class TestInfluxMetrics(unittest.TestCase):
         actual_df = imetrics.get_twap(input_df, quote, params)
         pd_testing.assert_frame_equal(actual_df, expected_df)
 
+    def test_get_twap_regular_grid(self):
+        """
+        get_twap(priceCumulatives, quote, params) should look back a constant
+        `params['window'] / params['period']` rows when `priceCumulatives` is
+        sampled on a regular `params['period']` grid, returning the same
+        rows as the `dynamic_window` search, including around a missed tick
+        """
+        params = imetrics.get_params()
+        quotes = imetrics.get_quotes()
+        quote = quotes[0]
+
+        period = params['period'] * 60
+        k = params['window'] // params['period']
+        max_rows = (k + 1) * 2
+        ts = 1636526054 + period * np.arange(40)
+        input_df = pd.DataFrame({
+            '_time': pd.to_datetime(ts, unit='s', utc=True),
+            '_field': 'tick_cumulative0',
+            '_value': 200 * ts,
+        })
+
+        actual_df = imetrics.get_twap(input_df, quote, params)
+        expected_df = pd.DataFrame({
+            'timestamp': ts[max_rows+k:].astype(float),
+            'window': float(k * period),
+            'twap': np.power(1.0001, 200.0),
+        })
+        pd_testing.assert_frame_equal(actual_df, expected_df)
+
+        actual_df = imetrics.get_twap(input_df, quote, params, invert=True)
+        expected_df['twap'] = 1 / expected_df['twap']
+        pd_testing.assert_frame_equal(actual_df, expected_df)
+
+        # A single missed tick only sends the rows whose lookback spans it
+        # through the `dynamic_window` search; the output is unchanged
+        gap_ts = np.delete(ts, 25)
+        gap_df = pd.DataFrame({
+            '_time': pd.to_datetime(gap_ts, unit='s', utc=True),
+            '_field': 'tick_cumulative0',
+            '_value': 200 * gap_ts,
+        })
+        dynamic_window = imetrics.dynamic_window
+
+        def search_only(df, max_rows, window, period=None):
+            return dynamic_window(df, max_rows, window)
+
+        with mock.patch.object(imetrics, 'dynamic_window',
+                               side_effect=search_only):
+            expected_df = imetrics.get_twap(gap_df, quote, params)
+
+        actual_df = imetrics.get_twap(gap_df, quote, params)
+        pd_testing.assert_frame_equal(actual_df, expected_df)
+        pd_testing.assert_frame_equal(
+            imetrics.dynamic_window(gap_df, max_rows, params['window'],
+                                    params['period']),
+            dynamic_window(gap_df, max_rows, params['window']))
+
+        # Alternating 50s jitter is too irregular for the constant lookback,
+        # but every `k` rows still span exactly `params['window']`
+        jitter = 50 * (np.arange(40) % 2)
+        input_df['_time'] = pd.to_datetime(ts + jitter, unit='s', utc=True)
+        input_df['_value'] = 200 * (ts + jitter)
+
+        actual_df = imetrics.get_twap(input_df, quote, params)
+        expected_df = pd.DataFrame({
+            'timestamp': (ts + jitter)[max_rows+k:].astype(float),
+            'window': float(k * period),
+            'twap': np.power(1.0001, 200.0),
+        })
+        pd_testing.assert_frame_equal(actual_df, expected_df)
+
     # def test_calc_vars(self):
     #     """
     #     calc_vars(mu, sig_sqrd, t, n, alphas) should calculate bracketed term